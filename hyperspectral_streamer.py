@@ -1,9 +1,27 @@
 import os
+import sys
 import numpy as np
 import cv2
 import threading
+import queue
+import json
 import time
-from HAIP_BlackIndustry import HAIP_BlackIndustry
+from multiprocessing import shared_memory, resource_tracker
+from HAIP_BlackIndustry import HAIP_BlackIndustry, pixel_formats
+
+try:
+    import numba
+    from numba import njit, prange
+except ImportError:
+    # numba is optional, the display falls back to plain NumPy without it
+    njit = None
+
+try:
+    import cupy as cp
+    import cupyx
+except ImportError:
+    # cupy is optional, it moves the 2D view onto a CUDA GPU
+    cp = None
 
 
 # ==============================================================
@@ -12,20 +30,161 @@ from HAIP_BlackIndustry import HAIP_BlackIndustry
 IP_ADDRESS = "192.168.7.1"
 CAMERA_MODE = 0
 FPS_TARGET = 450
+PIXEL_FORMAT = pixel_formats.MONO10  # any 10 bit format (MONO10, MONO10_4_5, MONO10_2_3), decoded to the uint16 cube
 
 EXPOSURE = 2200  # microseconds
 GAIN = 0        # dB
 
 SPATIAL_PIXELS = 640      # vertical (height)
 SPECTRAL_BANDS = 213      # spectral channels
-MAX_LINES = 1024          # horizontal (width)
+MAX_LINES = 1024          # horizontal (width), a power of two
+MAX_LINES_MASK = MAX_LINES - 1  # line count -> ring slot, count & MAX_LINES_MASK
+VIEW_LINES = MAX_LINES - 1      # 2D view width, the slot the camera is writing into is never shown
 BAND_AVG_WINDOW = 10      # spectral bands to average for grayscale
+DISPLAY_BANDS = None      # band indices to average instead (e.g. skipping bad bands), None = BAND_AVG_WINDOW centre bands
+DISPLAY_FPS = 30          # 2D view redraws per second, keys are still polled every 1 ms
+SCALE_EVERY = 10          # redraws between measurements of the view max that drives the 0-255 scale
+SCALE_EMA = 0.1           # weight of a new measurement in the running view max
+SCALE_RESEED = 10.0       # a measurement this many times off the running max replaces it (e.g. shutter opened)
+SCALE_FLOOR = 1.0         # lowest view max (raw counts) the scale is computed from, a dark view is not blown up
+
+# optional core sets (e.g. {0, 1, 2, 3} and {4, 5, 6, 7}), None = no pinning. Threads inherit the mask of the
+# thread that starts them, numba's parallel worker pool included (started by the first parallel kernel, unpack
+# or view), so give each set several cores or the parallel kernels run on one
+CAPTURE_CPUS = None       # cores for the capture thread and the camera threads it starts
+DISPLAY_CPUS = None       # cores for the main (display) and save threads
+
+USE_GPU = True            # build the 2D view on the GPU when cupy and a CUDA device are available
 
 SAVE_HSI = True
 SAVE_2D = True
 SAVE_DIR = "output"
 
+assert MAX_LINES & MAX_LINES_MASK == 0, "MAX_LINES must be a power of two"
+
+
+
+
+# ==============================================================
+# FUSED 2D VIEW (optional, numba)
+# ==============================================================
+make_view = None
+
+if njit is not None:
+    # nogil: the capture thread keeps pulling frames while the view is built
+    @njit(parallel=True, fastmath=True, cache=True, nogil=True)
+    def make_view(cube, start, band_lo, band_hi, out, scratch, scale):
+        """Band mean, scale (window max, floored, when scale <= 0) and uint8 cast of the ring window starting at `start`, returns the window max."""
+        n_lines, n_cols = cube.shape[0], out.shape[1]
+        col_max = np.zeros(n_cols, dtype=np.float32)
+        inv_bands = np.float32(1.0 / (band_hi - band_lo))
+
+        # 1. band mean per pixel, lines in parallel (each reads one contiguous frame)
+        for t in prange(n_cols):
+            line = (start + t) % n_lines
+            m = np.float32(0)
+            for i in range(out.shape[0]):
+                s = np.float32(0)
+                for b in range(band_lo, band_hi):
+                    s += cube[line, i, b]
+                s *= inv_bands
+                scratch[i, t] = s
+                m = max(m, s)
+            col_max[t] = m
+
+        # 2. scale and cast, the max comes free with pass 1 and goes back to the caller's running scale
+        m = col_max.max()
+        k = np.float32(scale)
+        if k <= 0:
+            k = np.float32(255.0 / max(m, SCALE_FLOOR))
+        for i in prange(out.shape[0]):
+            for t in range(n_cols):
+                out[i, t] = np.uint8(min(scratch[i, t] * k, np.float32(255)))
+        return m
+
 
+# ==============================================================
+# GPU 2D VIEW (optional, cupy)
+# ==============================================================
+class GpuView:
+    """Keeps the averaged band window of the (view) cube on the GPU and builds the 2D view there."""
+    def __init__(self, bands):
+        self.bands = bands
+        self.lines_d = cp.zeros((MAX_LINES, SPATIAL_PIXELS, bands.stop - bands.start), dtype=cp.uint16)
+        self.view_d = cp.empty((SPATIAL_PIXELS, VIEW_LINES), dtype=cp.uint8)
+        self.view_pinned = cupyx.empty_pinned((SPATIAL_PIXELS, VIEW_LINES), dtype=np.uint8)
+        self.stream = cp.cuda.Stream(non_blocking=True)
+        self.uploaded = 0
+        self.normalize = cp.ElementwiseKernel(
+            "float32 x, float32 scale", "uint8 y",
+            "y = (unsigned char)min(x * scale, 255.0f)",
+            "hsi_view_normalize")
+
+    def upload(self, cube, idx):
+        # only the band window of the lines written since the last tick goes to the device
+        first = max(self.uploaded, idx - MAX_LINES)
+        while first < idx:
+            start = first & MAX_LINES_MASK
+            stop = min(start + idx - first, MAX_LINES)
+            self.lines_d[start:stop].set(np.ascontiguousarray(cube[start:stop, :, self.bands]), stream=self.stream)
+            first += stop - start
+        self.uploaded = idx
+
+    def render(self, idx, out, scale=None):
+        # same scaling as the CPU views: the caller's running scale, or the window max (floored) when None
+        with self.stream:
+            # band mean (lines, spatial), rolled so the window starts at the oldest line, slot idx (being written) is left out
+            view = cp.roll(self.lines_d.mean(axis=2, dtype=cp.float32), -((idx + 1) & MAX_LINES_MASK), axis=0)[:VIEW_LINES].T
+            view_max = view.max()
+            if scale is None:
+                k = (255.0 / cp.maximum(view_max, cp.float32(SCALE_FLOOR))).astype(cp.float32)
+            else:
+                k = np.float32(scale)
+            self.normalize(view, k, self.view_d)
+            self.view_d.get(stream=self.stream, out=self.view_pinned)
+        self.stream.synchronize()
+        out[:] = self.view_pinned
+        return float(view_max) # window max for the running scale, already computed once the stream is synced
+
+
+# ==============================================================
+# SHARED CUBE
+# ==============================================================
+CUBE_HEADER = 64  # bytes before the cube: the int64 write index, padded to a cache line
+
+
+def shared_cube(name=None):
+    """Ring buffer cube and its write index in shared memory, created when name is None, else attached (e.g. from a viewer/saver process)."""
+    shape = (MAX_LINES, SPATIAL_PIXELS, SPECTRAL_BANDS)
+    if name is None:
+        # new shared memory is zero filled, the creator unlinks it
+        shm = shared_memory.SharedMemory(create=True, size=CUBE_HEADER + int(np.prod(shape)) * np.dtype(np.uint16).itemsize)
+    elif sys.version_info >= (3, 13):
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    else:
+        # before 3.13 attaching registers the block with this process's resource tracker,
+        # which would unlink it (or warn about a leak) when this process exits
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+    # the write index lives in the block too, so any process that attaches can follow the camera
+    write_index = np.ndarray((1,), dtype=np.int64, buffer=shm.buf)
+    return shm, np.ndarray(shape, dtype=np.uint16, buffer=shm.buf, offset=CUBE_HEADER), write_index
+
+
+# ==============================================================
+# CPU PINNING (Linux)
+# ==============================================================
+def pin_to_cpus(cpus, who):
+    """Pins the calling thread (and threads it starts later) to cpus, skipped where unsupported or unavailable."""
+    if cpus is None or not hasattr(os, "sched_setaffinity"):
+        return
+    cpus = set(cpus) & os.sched_getaffinity(0)
+    if not cpus:
+        print(f"[INFO] CPUs for {who} not available, not pinned.")
+        return
+    # pid 0 is the calling thread on Linux, not the whole process
+    os.sched_setaffinity(0, cpus)
+    print(f"[INFO] {who} pinned to CPUs {sorted(cpus)}.")
 
 
 # ==============================================================
@@ -33,114 +192,284 @@ SAVE_DIR = "output"
 # ==============================================================
 class CaptureThread(threading.Thread):
     """Captures lines from HAIP camera and writes into shared cube."""
-    def __init__(self, cube, write_index, stop_event, lock):
+    def __init__(self, cube, write_index, stop_event, view_cube=None, view_bands=None):
         super().__init__(daemon=True) # Daemon thread (auto-exit on main thread end)
         self.cube = cube
         self.write_index = write_index
         self.stop_event = stop_event
-        self.lock = lock
+        # optional: the view_bands of every line are gathered into view_cube, so the view reads them contiguously
+        self.view_cube = view_cube
+        self.view_bands = view_bands
         self.camera = HAIP_BlackIndustry()
+        self.filled = threading.Event() # set once the first MAX_LINES lines are in the cube
 
     def run(self):
-        print(f"[INFO] Connecting to HAIP at {IP_ADDRESS} ...")
-        cam = self.camera
-        cam.init(IP_ADDRESS)
-        cam.setMode(CAMERA_MODE)
-        cam.setGain(GAIN)
-        cam.setExposure(EXPOSURE)
-        cam.setFPS(FPS_TARGET)
-        cam.startCameraStream()
-        print("[INFO] Streaming started (shared memory).")
-
-        # Wait until the first valid frame is available
-        while cam.getImage() is None and not self.stop_event.is_set():
-            time.sleep(0.05)
-        print("[INFO] Camera stream initialized and returning frames.")
-
         try:
-            while not self.stop_event.is_set():
-                frame = cam.getImage()  # (640, 213)
-                if frame is None:
-                    time.sleep(0.001)
-                    continue
-
-                frame = frame.astype(np.float32)
-                with self.lock:
-                    idx = self.write_index[0] % MAX_LINES # get current index with wrap-around
-                    self.cube[:, :, idx] = frame
-                    self.write_index[0] += 1
-
-                # Optional small sleep to reduce CPU load without affecting FPS (e.g, if camera is slower, to prevent over-polling the getImage() and wasting CPU cycles)
-                # time.sleep(0.001)
+            # before the stream starts: the camera receive/unpack threads inherit the mask,
+            # so the 273 KB frame writes stay in the capture cores' caches
+            pin_to_cpus(CAPTURE_CPUS, "Capture")
+            print(f"[INFO] Connecting to HAIP at {IP_ADDRESS} ...")
+            cam = self.camera
+            cam.init(IP_ADDRESS)
+            cam.setMode(CAMERA_MODE)
+            cam.setGain(GAIN)
+            cam.setExposure(EXPOSURE)
+            cam.setFPS(FPS_TARGET)
+            # set before the uint16 cube lines are announced, the camera may still be in e.g. MONO8 from a previous run
+            cam.set_pixel_format(PIXEL_FORMAT)
+            # the cube lines are announced to the camera: every frame (640, 213) is decoded straight into
+            # cube[n & MAX_LINES_MASK] and on_frame(n) is called from the camera thread, no polling and no extra copy
+            # (raises if the camera frames do not match the cube lines), on_stream_end fires when the stream ends
+            cam.startCameraStream(buffers=self.cube, callback=self.on_frame, on_stop=self.on_stream_end)
+            print("[INFO] Streaming started (shared memory).")
+
+            try:
+                self.stop_event.wait()
+            finally:
+                # if anything crashes mid-capture, this ensures the stream closes cleanly and the camera doesn’t hang.
+                cam.stopCameraStream()
+                print("[INFO] Capture thread stopped.")
         finally:
-            # if anything crashes mid-capture, this ensures the stream closes cleanly and the camera doesn’t hang.
-            cam.stopCameraStream()
-            print("[INFO] Capture thread stopped.")
+            # wake main if capture ends before the cube filled (e.g. camera not reachable)
+            self.stop_event.set()
+            self.filled.set()
+
+    def on_frame(self, frame_id):
+        # single producer, single consumer: no lock, the line is complete before it is published
+        # by bumping write_index[0] (one aligned 64 bit store), readers only use lines below it
+        # frames are received and unpacked by the camera thread, this runs on it for every frame:
+        # the store and two compares take ~100 ns, the DISPLAY_BANDS gather (when set) a few microseconds
+        if self.view_bands is not None:
+            slot = frame_id & MAX_LINES_MASK
+            np.take(self.cube[slot], self.view_bands, axis=1, out=self.view_cube[slot])
+        self.write_index[0] = frame_id + 1
+        # one-off events, fired from here so nobody has to poll write_index for them
+        if frame_id == 0:
+            print("[INFO] Camera stream initialized and returning frames.")
+        if frame_id == MAX_LINES - 1:
+            self.filled.set()
+
+    def on_stream_end(self):
+        # stream thread ended (camera stopped, connection lost or on_frame raised): stop the pipeline,
+        # run() then closes the camera and main wakes up even if the cube never filled
+        self.stop_event.set()
+        self.filled.set()
+
+
+# ==============================================================
+# SAVE THREAD
+# ==============================================================
+class SaveThread(threading.Thread):
+    """Writes queued cubes and 2D views to disk so saving never stalls the display loop."""
+    def __init__(self, save_queue, cube, write_index):
+        super().__init__(daemon=True)
+        self.save_queue = save_queue
+        self.cube = cube
+        self.write_index = write_index
+        self.snapshot = None # allocated on the first cube save, then reused
+
+    def run(self):
+        while True:
+            item = self.save_queue.get()
+            if item is None: # sentinel from shutdown, everything queued before it is written
+                break
+            path, data = item
+            if data is self.cube:
+                self.save_cube(path)
+            else:
+                cv2.imwrite(path, data)
+                print("[INFO] Saved 2D grayscale image.")
+
+    def save_cube(self, path):
+        # the camera keeps writing while the ring is copied: snapshot it oldest line first (one memcpy),
+        # then drop the lines whose slots may have been overwritten during the copy, so nothing is torn
+        if self.snapshot is None:
+            self.snapshot = np.empty_like(self.cube)
+        i0 = int(self.write_index[0])
+        start = i0 & MAX_LINES_MASK
+        np.copyto(self.snapshot[:MAX_LINES - start], self.cube[start:])
+        np.copyto(self.snapshot[MAX_LINES - start:], self.cube[:start])
+        i1 = int(self.write_index[0])
+
+        # row r holds line i0 - MAX_LINES + r, lines from i0 on went into the rows up to i1 - i0 (incl. the one in flight)
+        skip = max(i1 - i0 + 1, MAX_LINES - i0)
+        if skip >= MAX_LINES:
+            print("[INFO] Camera overtook the cube copy, save skipped.")
+            return
+        first, last = i0 - MAX_LINES + skip, i0 - 1
+
+        # written under a temporary name and renamed, a reader never sees a partial file
+        # on disk the cube keeps its (spatial, spectral, lines) layout: transposed here, in one strided copy
+        # into the mapped file (np.save of the transposed view goes through small buffered chunks, ~10x slower)
+        tmp = path + ".tmp"
+        lines = self.snapshot[skip:]
+        out = np.lib.format.open_memmap(tmp, mode="w+", dtype=lines.dtype,
+                                        shape=(SPATIAL_PIXELS, SPECTRAL_BANDS, len(lines)))
+        out[...] = lines.transpose(1, 2, 0)
+        out.flush()
+        del out
+        os.replace(tmp, path)
+        # sidecar with the camera line numbers of the first and last saved line (rows are in time order)
+        with open(os.path.splitext(path)[0] + ".json", "w") as f:
+            json.dump({"first_line": first, "last_line": last, "lines": last - first + 1}, f)
+        print(f"[INFO] Saved HSI cube, lines {first}-{last}.")
 
 
 # ==============================================================
 # MAIN PIPELINE
 # ==============================================================
 def main():
-    cube = np.zeros((SPATIAL_PIXELS, SPECTRAL_BANDS, MAX_LINES), dtype=np.float32)
-    write_index = [0]
-    lock = threading.Lock()
+    # checked once up front, a bad index would otherwise raise on the camera thread
+    if DISPLAY_BANDS is not None and (len(DISPLAY_BANDS) == 0 or min(DISPLAY_BANDS) < 0 or max(DISPLAY_BANDS) >= SPECTRAL_BANDS):
+        raise ValueError(f"DISPLAY_BANDS must be band indices in 0..{SPECTRAL_BANDS - 1}, got {DISPLAY_BANDS}")
+
+    # first, so the capture core is never picked for display work (the save thread inherits this too)
+    pin_to_cpus(DISPLAY_CPUS, "Display")
+
+    # camera native dtype, 10 bit pixels fit uint16 (half the memory and bandwidth of float32)
+    # lines first: every frame is one contiguous block and the bands of a pixel are adjacent
+    # the cube lives in shared memory, other processes can map it zero-copy with shared_cube(name)
+    # and follow write_index (the int64 in the block header) without copying the cube
+    # (not file backed: a mapped file would be written back to disk at 450 FPS, files are only written on save)
+    shm, cube, write_index = shared_cube()
+    print(f"[INFO] Cube shared as '{shm.name}' {cube.shape} {cube.dtype}.")
     stop_event = threading.Event()
 
-    capture_thread = CaptureThread(cube, write_index, stop_event, lock)
+    # bands averaged for the 2D view: the centre window is a contiguous slice of the cube,
+    # scattered DISPLAY_BANDS are gathered once per line at ingest into a compact view cube,
+    # so the view always reads a dense band prefix and never fancy-indexes the whole window
+    if DISPLAY_BANDS is None:
+        mid = SPECTRAL_BANDS // 2
+        bands = slice(mid - BAND_AVG_WINDOW // 2, mid + BAND_AVG_WINDOW // 2)
+        view_cube, view_bands = cube, None
+    else:
+        view_bands = np.asarray(DISPLAY_BANDS, dtype=np.intp)
+        bands = slice(0, len(view_bands))
+        view_cube = np.zeros((MAX_LINES, SPATIAL_PIXELS, len(view_bands)), dtype=np.uint16)
+
+    # display buffers, allocated once and refilled every tick
+    view_2d = np.empty((SPATIAL_PIXELS, VIEW_LINES), dtype=np.uint8)
+    view_f32 = np.empty((SPATIAL_PIXELS, VIEW_LINES), dtype=np.float32)
+
+    gpu_view = GpuView(bands) if USE_GPU and cp is not None and cp.cuda.is_available() else None
+    if gpu_view is not None:
+        print("[INFO] Building the 2D view on the GPU.")
+
+    view_kernel = make_view if gpu_view is None else None
+    if view_kernel is not None:
+        if PIXEL_FORMAT in (pixel_formats.MONO10_4_5, pixel_formats.MONO10_2_3) and "NUMBA_THREADING_LAYER" not in os.environ:
+            # packed frames: the view kernel runs while the camera thread runs its unpack kernel
+            numba.config.THREADING_LAYER = "threadsafe"
+        try:
+            # one run before capture starts: numba's thread pool is started here on the main thread
+            # and the first redraw does not wait for the kernel to load
+            view_kernel(view_cube, 0, bands.start, bands.stop, view_2d, view_f32, 0.0)
+        except ValueError as e:
+            # no thread safe layer (neither TBB nor OpenMP installed): numba is left to the unpack kernel
+            print(f"[INFO] numba view kernel unavailable, NumPy view used instead ({e.args[0].splitlines()[0]})")
+            numba.config.THREADING_LAYER = "default"
+            view_kernel = None
+
+    capture_thread = CaptureThread(cube, write_index, stop_event, view_cube, view_bands)
     capture_thread.start()
 
+    save_queue = queue.Queue(maxsize=4)
+    save_thread = SaveThread(save_queue, cube, write_index)
+    save_thread.start()
+
     print("[INFO] Press 's' to save or 'q' to quit.")
     t0 = time.time()
 
-    try:
-        while not stop_event.is_set():
-            with lock:
-                idx = write_index[0]
-
-            if idx < MAX_LINES:
-                # Wait until at least one full 2D frame is formed
-                time.sleep(0.01)
-                continue
-
-            # 1. Take last MAX_LINES (1024) slices from cube
-            cube_section = cube[:, :, (idx - MAX_LINES) % MAX_LINES : idx % MAX_LINES]
-            # Handle wrap-around in ring buffer
-            if cube_section.shape[2] != MAX_LINES:
-                cube_section = np.concatenate(
-                    (cube[:, :, (idx - MAX_LINES) % MAX_LINES:], cube[:, :, : idx % MAX_LINES]),
-                    axis=2,
-                )
-
-            # 2. Average selected bands -> 2D grayscale
-            mid = SPECTRAL_BANDS // 2
-            bands = slice(mid - BAND_AVG_WINDOW // 2, mid + BAND_AVG_WINDOW // 2)
-            view_2d = np.mean(cube_section[:, bands, :], axis=1)  # (640, 1024)
+    # NumPy path: the band mean is a float32 matrix-vector product (BLAS sgemv) with per-band weights,
+    # uniform over the window here, a spectral response curve could be used instead
+    # (cv2.reduce REDUCE_AVG over the (lines * spatial, bands) window takes the same time: ~19 ms a redraw
+    # either way, ~15 ms of it the band window copy out of the ring, so the weighted sgemv is kept)
+    if gpu_view is None and view_kernel is None:
+        band_weights = np.full(bands.stop - bands.start, 1.0 / (bands.stop - bands.start), dtype=np.float32)
+        band_f32 = np.empty((VIEW_LINES, SPATIAL_PIXELS, bands.stop - bands.start), dtype=np.float32)
+        lines_f32 = np.empty((VIEW_LINES, SPATIAL_PIXELS), dtype=np.float32)
+
+    last_draw = 0.0
+    # 0-255 scale of the views (CPU and GPU): 255 / a running average of the view max, seeded by the first draw,
+    # so the max is only measured every SCALE_EVERY redraws and the brightness does not flicker
+    scale = None
+    view_max = None
+    draws = 0
 
-            # Normalize to 0–255 uint8
-            view_2d = np.clip(view_2d / np.max(view_2d) * 255, 0, 255).astype(np.uint8)
-
-            # Convert to BGR for display
-            view_bgr = cv2.cvtColor(view_2d, cv2.COLOR_GRAY2BGR)
+    try:
+        # Wait until at least one full 2D frame is formed
+        capture_thread.filled.wait()
 
+        while not stop_event.is_set():
+            idx = int(write_index[0]) # lines below idx are complete
+            # one-frame guard: frame idx is being decoded into slot idx & MAX_LINES_MASK right now,
+            # the view shows the VIEW_LINES lines before it, oldest first from the slot after it
+            start = (idx + 1) & MAX_LINES_MASK
+
+            # redraw at most DISPLAY_FPS times a second, the ring only advances ~15 lines per redraw at 450 FPS
+            now = time.monotonic()
+            if now - last_draw >= 1.0 / DISPLAY_FPS:
+                last_draw = now
+                measure = scale is None or draws % SCALE_EVERY == 0
+                draws += 1
+                cur = None
+
+                if gpu_view is not None:
+                    # new lines go up to the device, the reduced uint8 view comes back
+                    gpu_view.upload(view_cube, idx)
+                    m = gpu_view.render(idx, view_2d, scale)
+                    cur = m if measure else None
+                elif view_kernel is not None:
+                    # last VIEW_LINES slices, band mean and normalisation fused in one kernel (wrap-around included)
+                    m = view_kernel(view_cube, start, bands.start, bands.stop, view_2d, view_f32,
+                                    scale or 0.0)
+                    cur = m if measure else None
+                else:
+                    # 1. + 2. Average selected bands of the last VIEW_LINES (1023) slices -> 2D grayscale (640, 1023)
+                    # the ring wraps at the end of the cube: the band window of both contiguous parts goes into one
+                    # float32 buffer in window order (no full-cube copy), then one sgemv and a transpose into the view
+                    split = min(MAX_LINES - start, VIEW_LINES)
+                    np.copyto(band_f32[:split], view_cube[start:start + split, :, bands])
+                    np.copyto(band_f32[split:], view_cube[:VIEW_LINES - split, :, bands])
+                    np.matmul(band_f32, band_weights, out=lines_f32)
+                    cv2.transpose(lines_f32, view_f32)
+
+                    # Normalize to 0–255 uint8: scale and saturating cast in one OpenCV pass, the max scan
+                    # only runs on measuring redraws (the first one uses its own max right away)
+                    if measure:
+                        cur = cv2.minMaxLoc(view_f32)[1]
+                    cv2.convertScaleAbs(view_f32, view_2d, alpha=scale or 255.0 / max(cur, SCALE_FLOOR))
+
+                if cur is not None:
+                    # averaged on the max, not on 255 / max: a dark first view is not amplified for minutes,
+                    # and a jump by an order of magnitude (dark frames at start-up, lens cap off) re-seeds it
+                    floor = max(view_max or 0.0, SCALE_FLOOR)
+                    if view_max is None or not floor / SCALE_RESEED <= cur <= floor * SCALE_RESEED:
+                        view_max = cur
+                    else:
+                        view_max = (1.0 - SCALE_EMA) * view_max + SCALE_EMA * cur
+                    scale = 255.0 / max(view_max, SCALE_FLOOR)
+
+                # =========================================================
+                # Display live 2D image
+                # =========================================================
+                cv2.imshow("Hyperspectral 2D Stream", view_2d) # single channel uint8 is shown as grayscale, no BGR copy
 
-            # =========================================================
-            # Display live 2D image
-            # =========================================================
-            cv2.imshow("Hyperspectral 2D Stream", view_bgr)
             key = cv2.waitKey(1) & 0xFF
 
             # =========================================================
             # Optional save
             # =========================================================
             if key == ord("s"):
+                # handed to the save thread, the loop keeps displaying while it writes
                 os.makedirs(SAVE_DIR, exist_ok=True)
-                if SAVE_HSI:
-                    np.save(f"{SAVE_DIR}/cube_{int(time.time())}.npy", cube)
-                    print("[INFO] Saved HSI cube.")
-                if SAVE_2D:
-                    cv2.imwrite(f"{SAVE_DIR}/view2D_{int(time.time())}.png", view_2d)
-                    print("[INFO] Saved 2D grayscale image.")
+                try:
+                    if SAVE_HSI:
+                        save_queue.put_nowait((f"{SAVE_DIR}/cube_{int(time.time())}.npy", cube))
+                    if SAVE_2D:
+                        save_queue.put_nowait((f"{SAVE_DIR}/view2D_{int(time.time())}.png", view_2d.copy())) # view_2d is refilled next tick
+                except queue.Full:
+                    print("[INFO] Still saving, save request skipped.")
 
             if key == ord("q"):
                 stop_event.set()
@@ -155,7 +484,14 @@ def main():
         print(f"[INFO] Lines captured ≈ {write_index[0]} "
               f"({write_index[0]/elapsed:.1f} FPS)")
         capture_thread.join(timeout=2) # wait for capture thread to end
+        save_queue.put(None)
+        save_thread.join() # pending saves still read the cube
         cv2.destroyAllWindows()
+        if not capture_thread.is_alive():
+            # only unmapped once the camera can no longer write into it
+            del cube, write_index
+            shm.close()
+        shm.unlink()
         print("[INFO] Stream ended.")
 
 